@@ -10,9 +10,18 @@ Deploy: Docker en VPS
 """
 
 import os
+import re
+import html
+import queue
 import sqlite3
 import asyncio
-from datetime import datetime, timedelta
+import time
+import statistics
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from datetime import date, datetime, timedelta
 from pathlib import Path
 import warnings
 
@@ -28,71 +37,171 @@ import sheets_sync
 DB_PATH = os.environ.get("DB_PATH", "/app/data/gastos.db")
 PHOTOS_DIR = os.environ.get("PHOTOS_DIR", "/app/data/photos")
 CURRENCY = "S/"
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
 
-AUTHORIZED_USERS = set(
+AUTHORIZED_USERS = frozenset(
     int(uid.strip())
     for uid in os.environ.get("AUTHORIZED_USERS", "").split(",")
     if uid.strip()
 )
+_AUTH_REQUIRED = bool(AUTHORIZED_USERS)
+
+# Sheets config comes from env vars, which cannot change while the bot runs
+_SHEETS_ENABLED = sheets_sync.is_enabled()
 
 # ══════════════════════════════════════════════
 # DATABASE
 # ══════════════════════════════════════════════
 
-def get_db():
-    Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+_POOL = queue.Queue(maxsize=DB_POOL_SIZE)
+_WRITE_LOCK = threading.Lock()
+
+def _connect():
+    """Open a connection configured for the pool."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # page_size only takes effect on a brand-new file, so it goes before WAL
+    conn.execute("PRAGMA page_size=4096")
     conn.execute("PRAGMA journal_mode=WAL")
+    # WAL survives crashes with NORMAL; skips the fsync on every commit
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    # Keep the WAL file bounded (checkpoint every ~1000 pages, cap 64 MiB)
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    conn.execute("PRAGMA journal_size_limit=67108864")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Memory-map up to 256 MiB so reads skip read() and the user-space copy
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA foreign_keys=ON")
     return conn
 
-def init_db():
-    Path(PHOTOS_DIR).mkdir(parents=True, exist_ok=True)
-    conn = get_db()
+def open_pool():
+    """Pre-open the pooled connections (called once from init_db)."""
+    Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+    while not _POOL.full():
+        _POOL.put(_connect())
+
+def close_pool():
+    """Checkpoint the WAL and close every pooled connection (on shutdown)."""
+    conns = []
+    while not _POOL.empty():
+        conns.append(_POOL.get_nowait())
+    if conns:
+        conns[0].execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    for conn in conns:
+        conn.close()
+
+def checkpoint_wal():
+    """Fold the WAL back into the database and truncate the -wal file."""
+    with db() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+@contextmanager
+def db():
+    """Borrow a pooled connection; it goes back to the pool on exit."""
+    conn = _POOL.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _POOL.put(conn)
+
+def _migrate_amount_cents(conn):
+    """Rebuild a pre-existing transactions table from REAL amount to INTEGER cents."""
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(transactions)")]
+    if "amount" not in columns:
+        return
+    print("🔧 Migrating transactions.amount to amount_cents...")
     conn.executescript("""
-        CREATE TABLE IF NOT EXISTS transactions (
+        BEGIN;
+        CREATE TABLE transactions_new (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             type TEXT NOT NULL CHECK(type IN ('gasto', 'ingreso')),
             category TEXT NOT NULL,
-            amount REAL NOT NULL,
+            amount_cents INTEGER NOT NULL,
             description TEXT,
             payment_method TEXT DEFAULT 'Efectivo',
             photo_path TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
+        INSERT INTO transactions_new
+            (id, user_id, type, category, amount_cents, description, payment_method, photo_path, created_at)
+        SELECT id, user_id, type, category, CAST(ROUND(amount * 100) AS INTEGER),
+               description, payment_method, photo_path, created_at
+        FROM transactions;
+        DROP TABLE transactions;
+        ALTER TABLE transactions_new RENAME TO transactions;
+        COMMIT;
+    """)
 
-        CREATE TABLE IF NOT EXISTS categories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            emoji TEXT DEFAULT '📌',
-            type TEXT NOT NULL CHECK(type IN ('gasto', 'ingreso')),
-            UNIQUE(user_id, name, type)
-        );
+@contextmanager
+def db_write():
+    """Borrow a connection inside a write transaction (commit/rollback on exit).
 
-        CREATE TABLE IF NOT EXISTS recurring (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            type TEXT NOT NULL CHECK(type IN ('gasto', 'ingreso')),
-            category TEXT NOT NULL,
-            amount REAL NOT NULL,
-            description TEXT,
-            payment_method TEXT DEFAULT 'Transferencia',
-            day_of_month INTEGER NOT NULL DEFAULT 1,
-            active INTEGER DEFAULT 1,
-            last_applied TEXT
-        );
+    Writers are serialised in-process so they queue on a lock instead of
+    spinning in SQLite's busy handler against each other.
+    """
+    with _WRITE_LOCK, db() as conn, conn:
+        yield conn
 
-        CREATE INDEX IF NOT EXISTS idx_trans_user ON transactions(user_id);
-        CREATE INDEX IF NOT EXISTS idx_trans_date ON transactions(created_at);
-        CREATE INDEX IF NOT EXISTS idx_trans_type ON transactions(user_id, type);
-        CREATE INDEX IF NOT EXISTS idx_recurring_user ON recurring(user_id);
-    """)
-    conn.close()
+def init_db():
+    Path(PHOTOS_DIR).mkdir(parents=True, exist_ok=True)
+    open_pool()
+    with db() as conn:
+        _migrate_amount_cents(conn)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                type TEXT NOT NULL CHECK(type IN ('gasto', 'ingreso')),
+                category TEXT NOT NULL,
+                amount_cents INTEGER NOT NULL,
+                description TEXT,
+                payment_method TEXT DEFAULT 'Efectivo',
+                photo_path TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE TABLE IF NOT EXISTS categories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                emoji TEXT DEFAULT '📌',
+                type TEXT NOT NULL CHECK(type IN ('gasto', 'ingreso')),
+                UNIQUE(user_id, name, type)
+            );
+
+            CREATE TABLE IF NOT EXISTS recurring (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                type TEXT NOT NULL CHECK(type IN ('gasto', 'ingreso')),
+                category TEXT NOT NULL,
+                amount REAL NOT NULL,
+                description TEXT,
+                payment_method TEXT DEFAULT 'Transferencia',
+                day_of_month INTEGER NOT NULL DEFAULT 1,
+                active INTEGER DEFAULT 1,
+                last_applied TEXT
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_trans_date ON transactions(created_at);
+            -- Covers the user/type/date range scans (sums, /hoy, /resumen)
+            CREATE INDEX IF NOT EXISTS idx_trans_user_type_date
+                ON transactions(user_id, type, created_at DESC, amount_cents, category);
+            DROP INDEX IF EXISTS idx_trans_user;
+            DROP INDEX IF EXISTS idx_trans_type;
+            CREATE INDEX IF NOT EXISTS idx_recurring_user ON recurring(user_id);
+        """)
+
+# Users whose default categories are known to exist (per process)
+_SEEDED = set()
 
 def seed_categories(user_id: int):
-    conn = get_db()
+    if user_id in _SEEDED:
+        return
     default_gastos = [
         ("🏠 Vivienda", "🏠"), ("🍽️ Comida", "🍽️"), ("🚗 Transporte", "🚗"),
         ("💡 Servicios", "💡"), ("🏥 Salud", "🏥"), ("📚 Educación", "📚"),
@@ -103,157 +212,292 @@ def seed_categories(user_id: int):
         ("💼 Salario", "💼"), ("💻 Freelance", "💻"), ("📈 Inversiones", "📈"),
         ("🏠 Rentas", "🏠"), ("🎁 Otros ingresos", "🎁"),
     ]
-    for name, emoji in default_gastos:
-        conn.execute(
-            "INSERT OR IGNORE INTO categories (user_id, name, emoji, type) VALUES (?, ?, ?, 'gasto')",
-            (user_id, name, emoji)
-        )
-    for name, emoji in default_ingresos:
-        conn.execute(
-            "INSERT OR IGNORE INTO categories (user_id, name, emoji, type) VALUES (?, ?, ?, 'ingreso')",
-            (user_id, name, emoji)
-        )
-    conn.commit()
-    conn.close()
+    rows = [(user_id, name, emoji, "gasto") for name, emoji in default_gastos]
+    rows += [(user_id, name, emoji, "ingreso") for name, emoji in default_ingresos]
+    with db_write() as conn:
+        if not conn.execute(SQL_HAS_CATEGORIES, (user_id,)).fetchone():
+            conn.executemany(SQL_SEED_CATEGORY, rows)
+    _SEEDED.add(user_id)
 
 # ══════════════════════════════════════════════
 # QUERIES
 # ══════════════════════════════════════════════
 
-def add_transaction(user_id, tx_type, category, amount, description="", payment_method="Efectivo", photo_path=None):
-    conn = get_db()
-    conn.execute(
-        "INSERT INTO transactions (user_id, type, category, amount, description, payment_method, photo_path) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (user_id, tx_type, category, amount, description, payment_method, photo_path)
+# Month-wide queries spell out type IN (...) so the (user_id, type, created_at)
+# index can seek the date range per type instead of scanning all user rows.
+# Hot statements are kept as constants so every pooled connection hits its
+# compiled-statement cache instead of re-parsing the SQL per update.
+# Amounts are stored as integer cents; sums stay exact and are converted back
+# to soles (as "amount"/"total") only in the projection.
+SQL_ADD_TX = (
+    "INSERT INTO transactions (user_id, type, category, amount_cents, description, payment_method, photo_path) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_TODAY_TOTAL = (
+    "SELECT COALESCE(SUM(amount_cents), 0) FROM transactions "
+    "WHERE user_id = ? AND type = 'gasto' AND created_at >= ? AND created_at < ?"
+)
+SQL_START_STATS = """
+    SELECT
+        COALESCE(SUM(CASE WHEN type='gasto' AND created_at >= ? THEN amount_cents END), 0) / 100.0 as today,
+        COALESCE(SUM(CASE WHEN type='ingreso' THEN amount_cents END), 0) / 100.0 as ingresos,
+        COALESCE(SUM(CASE WHEN type='gasto' THEN amount_cents END), 0) / 100.0 as gastos
+    FROM transactions WHERE user_id = ? AND type IN ('gasto', 'ingreso') AND created_at >= ?
+"""
+# Per-category gastos (kind 'C') and month totals by type (kind 'T') in one pass
+SQL_RESUMEN = """
+    SELECT 'C' as kind, category, SUM(amount_cents) / 100.0 as total, COUNT(*) as count
+    FROM transactions
+    WHERE user_id = ? AND type = 'gasto' AND created_at >= ?
+    GROUP BY category
+    UNION ALL
+    SELECT 'T', type, SUM(amount_cents) / 100.0, COUNT(*)
+    FROM transactions
+    WHERE user_id = ? AND type IN ('gasto', 'ingreso') AND created_at >= ?
+    GROUP BY type
+    ORDER BY kind, total DESC
+"""
+SQL_DAILY_GASTOS = (
+    "SELECT SUM(amount_cents) FROM transactions "
+    "WHERE user_id = ? AND type = 'gasto' AND created_at >= ? "
+    "GROUP BY substr(created_at, 1, 10)"
+)
+# id is AUTOINCREMENT, so it orders like created_at but without same-second ties
+SQL_RECENT = (
+    "SELECT type, category, amount_cents / 100.0 as amount, description, payment_method, photo_path, "
+    "strftime('%d/%m %H:%M', created_at) as dt "
+    "FROM transactions WHERE user_id = ? ORDER BY id DESC LIMIT ?"
+)
+# Newest row for the user, removed and returned in one statement (SQLite ≥ 3.35)
+SQL_DELETE_LAST_TX = """
+    DELETE FROM transactions
+    WHERE id = (SELECT id FROM transactions WHERE user_id = ? ORDER BY id DESC LIMIT 1)
+    RETURNING type, category, amount_cents, amount_cents / 100.0 as amount, photo_path, created_at
+"""
+SQL_CATEGORIES = "SELECT name, emoji FROM categories WHERE user_id = ? AND type = ? ORDER BY name"
+SQL_HOY = """
+    SELECT category, amount_cents / 100.0 as amount, description, payment_method, photo_path
+    FROM transactions
+    WHERE user_id = ? AND type = 'gasto' AND created_at >= ? AND created_at < ?
+    ORDER BY created_at DESC
+"""
+SQL_HAS_CATEGORIES = "SELECT 1 FROM categories WHERE user_id = ? LIMIT 1"
+SQL_SEED_CATEGORY = "INSERT OR IGNORE INTO categories (user_id, name, emoji, type) VALUES (?, ?, ?, ?)"
+SQL_ADD_RECURRING = (
+    "INSERT INTO recurring (user_id, type, category, amount, description, payment_method, day_of_month) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_RECURRING = "SELECT * FROM recurring WHERE user_id = ? AND active = 1 ORDER BY day_of_month"
+SQL_RECURRING_TOTALS = (
+    "SELECT type, COALESCE(SUM(amount), 0) FROM recurring "
+    "WHERE user_id = ? AND active = 1 GROUP BY type"
+)
+SQL_DISABLE_RECURRING = "UPDATE recurring SET active = 0 WHERE id = ? AND user_id = ?"
+SQL_DUE_RECURRING = (
+    "SELECT * FROM recurring WHERE active = 1 AND day_of_month = ? "
+    "AND (last_applied IS NULL OR last_applied != ?)"
+)
+SQL_APPLY_RECURRING_TX = (
+    "INSERT INTO transactions (user_id, type, category, amount_cents, description, payment_method) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+SQL_MARK_APPLIED = "UPDATE recurring SET last_applied = ? WHERE id = ?"
+
+# Largest accepted amount in soles: its cents stay far inside SQLite's 64-bit
+# INTEGER and exact as a float
+MAX_AMOUNT = 10**12
+
+def to_cents(amount):
+    """Soles → integer cents, as stored in transactions.amount_cents."""
+    if not 0 <= amount <= MAX_AMOUNT:  # also rejects inf/nan
+        raise ValueError(f"amount out of range: {amount!r}")
+    return int(round(amount * 100))
+
+@lru_cache(maxsize=4)
+def day_keys(ordinal):
+    """Date strings for one calendar day, formatted once per day.
+
+    Returns (YYYY-MM-DD, day start, next day start, first of the month).
+    """
+    d = date.fromordinal(ordinal)
+    today = d.isoformat()
+    return (
+        today,
+        f"{today} 00:00:00",
+        f"{(d + timedelta(days=1)).isoformat()} 00:00:00",
+        d.replace(day=1).isoformat(),
     )
-    conn.commit()
-    conn.close()
-    # Sync to Google Sheets
-    if sheets_sync.is_enabled():
-        print(f"📊 Google Sheets is enabled, syncing transaction...")
-        result = sheets_sync.sync_transaction(tx_type, category, amount, description, payment_method)
-        if not result:
-            print("⚠️ Failed to sync to Google Sheets")
-
-def get_today_total(user_id):
-    conn = get_db()
-    today = datetime.now().strftime("%Y-%m-%d")
-    row = conn.execute(
-        "SELECT COALESCE(SUM(amount), 0) as total FROM transactions WHERE user_id = ? AND type = 'gasto' AND DATE(created_at) = ?",
-        (user_id, today)
-    ).fetchone()
-    conn.close()
-    return row["total"]
-
-def get_month_summary(user_id):
-    conn = get_db()
-    month_start = datetime.now().replace(day=1).strftime("%Y-%m-%d")
-    row = conn.execute("""
-        SELECT
-            COALESCE(SUM(CASE WHEN type='ingreso' THEN amount ELSE 0 END), 0) as ingresos,
-            COALESCE(SUM(CASE WHEN type='gasto' THEN amount ELSE 0 END), 0) as gastos
-        FROM transactions WHERE user_id = ? AND created_at >= ?
-    """, (user_id, month_start)).fetchone()
-    conn.close()
-    return row["ingresos"], row["gastos"]
-
-def get_summary_by_category(user_id, days=30):
-    conn = get_db()
-    since = (datetime.now() - timedelta(days=days)).isoformat()
-    rows = conn.execute("""
-        SELECT category, SUM(amount) as total, COUNT(*) as count
-        FROM transactions
-        WHERE user_id = ? AND type = 'gasto' AND created_at >= ?
-        GROUP BY category ORDER BY total DESC
-    """, (user_id, since)).fetchall()
-    conn.close()
-    return rows
+
+def fetch_tuple(conn, sql, params):
+    """fetchone() as a plain tuple, skipping the Row wrapper for aggregates."""
+    cur = conn.cursor()
+    cur.row_factory = None
+    return cur.execute(sql, params).fetchone()
+
+def date_windows(now=None, days=30):
+    """Query bounds from a single clock read.
+
+    Returns today's [start, end) timestamps (comparable with created_at), the
+    first day of the month and the start of the last `days` days.
+    """
+    now = now or datetime.now()
+    _, start, end, month_start = day_keys(now.toordinal())
+    return start, end, month_start, (now - timedelta(days=days)).isoformat()
+
+def day_range(now=None):
+    """[start, end) timestamps of the current day."""
+    return date_windows(now)[:2]
+
+# user_id → (YYYY-MM-DD, today's gasto total in cents), kept current by writes and
+# refilled from SQLite on a miss or when the day rolls over; only touched
+# while holding _WRITE_LOCK (inside db_write)
+_TODAY = {}
+
+def add_transaction(user_id, tx_type, category, amount, description="", payment_method="Efectivo", photo_path=None):
+    """Insert a transaction and return the user's gasto total for today.
+
+    The total comes from the in-memory counter when it is warm; otherwise it
+    is read inside the same transaction as the INSERT. Google Sheets is synced
+    by the caller through queue_sheets_sync().
+    """
+    now = datetime.now()
+    today = day_keys(now.toordinal())[0]
+    cents = to_cents(amount)
+    with db_write() as conn:
+        conn.execute(
+            SQL_ADD_TX,
+            (user_id, tx_type, category, cents, description, payment_method, photo_path)
+        )
+        cur = _TODAY.get(user_id)
+        if cur and cur[0] == today:
+            today_cents = cur[1] + (cents if tx_type == "gasto" else 0)
+        else:
+            today_cents = fetch_tuple(conn, SQL_TODAY_TOTAL, (user_id, *day_range(now)))[0]
+        _TODAY[user_id] = (today, today_cents)
+    return today_cents / 100
+
+def get_start_stats(user_id):
+    """Today's gastos plus the month's ingresos/gastos in one query."""
+    today, _, month_start, _ = date_windows()
+    with db() as conn:
+        return fetch_tuple(conn, SQL_START_STATS, (today, user_id, month_start))
+
+def get_resumen(user_id, days=30):
+    """Month ingresos/gastos and the last `days` of gastos by category."""
+    _, _, month_start, since = date_windows(days=days)
+    with db() as conn:
+        rows = conn.execute(SQL_RESUMEN, (user_id, since, user_id, month_start)).fetchall()
+    totals = {r["category"]: r["total"] for r in rows if r["kind"] == "T"}
+    by_category = [r for r in rows if r["kind"] == "C"]
+    return totals.get("ingreso", 0), totals.get("gasto", 0), by_category
+
+def monthly_stats(user_id):
+    """Spread of this month's daily gasto totals (days with spending only).
+
+    SQLite does the per-day reduction, so Python only sees ≤31 numbers.
+    """
+    month_start = date_windows()[2]
+    with db() as conn:
+        cur = conn.cursor()
+        cur.row_factory = None
+        daily = [cents / 100 for (cents,) in cur.execute(SQL_DAILY_GASTOS, (user_id, month_start))]
+    if not daily:
+        return {"days": 0, "total": 0, "mean": 0, "stdev": 0, "p90": 0, "max": 0}
+    return {
+        "days": len(daily),
+        "total": sum(daily),
+        "mean": statistics.fmean(daily),
+        "stdev": statistics.pstdev(daily),
+        # The month's days are the whole population: interpolate, never extrapolate
+        "p90": statistics.quantiles(daily, n=10, method="inclusive")[-1] if len(daily) > 1 else daily[0],
+        "max": max(daily),
+    }
 
 def get_recent(user_id, limit=10):
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-        (user_id, limit)
-    ).fetchall()
-    conn.close()
+    with db() as conn:
+        rows = conn.execute(SQL_RECENT, (user_id, limit)).fetchall()
     return rows
 
 def delete_last_transaction(user_id):
-    conn = get_db()
-    row = conn.execute(
-        "SELECT id, category, amount, photo_path FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
-        (user_id,)
-    ).fetchone()
-    if row:
-        conn.execute("DELETE FROM transactions WHERE id = ?", (row["id"],))
-        conn.commit()
-        if row["photo_path"] and os.path.exists(row["photo_path"]):
+    with db_write() as conn:
+        row = conn.execute(SQL_DELETE_LAST_TX, (user_id,)).fetchone()
+        cur = _TODAY.get(user_id)
+        if row and cur and row["type"] == "gasto" and row["created_at"].startswith(cur[0]):
+            _TODAY[user_id] = (cur[0], cur[1] - row["amount_cents"])
+    if row and row["photo_path"]:
+        try:
             os.remove(row["photo_path"])
-        # Sync delete to Google Sheets
-        if sheets_sync.is_enabled():
-            sheets_sync.sync_delete_last()
-    conn.close()
+        except FileNotFoundError:
+            pass
     return row
 
 def get_categories(user_id, tx_type):
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT name, emoji FROM categories WHERE user_id = ? AND type = ? ORDER BY name",
-        (user_id, tx_type)
-    ).fetchall()
-    conn.close()
+    with db() as conn:
+        rows = conn.execute(SQL_CATEGORIES, (user_id, tx_type)).fetchall()
     return rows
 
+def get_or_seed_categories(user_id, tx_type):
+    seed_categories(user_id)
+    return get_categories(user_id, tx_type)
+
+def get_today_gastos(user_id):
+    start, end = day_range()
+    with db() as conn:
+        return conn.execute(SQL_HOY, (user_id, start, end)).fetchall()
+
 # ── Recurring ──
 
 def add_recurring(user_id, tx_type, category, amount, description, payment_method, day_of_month):
-    conn = get_db()
-    conn.execute(
-        "INSERT INTO recurring (user_id, type, category, amount, description, payment_method, day_of_month) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (user_id, tx_type, category, amount, description, payment_method, day_of_month)
-    )
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute(
+            SQL_ADD_RECURRING,
+            (user_id, tx_type, category, amount, description, payment_method, day_of_month)
+        )
 
 def get_recurring(user_id):
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM recurring WHERE user_id = ? AND active = 1 ORDER BY day_of_month",
-        (user_id,)
-    ).fetchall()
-    conn.close()
+    with db() as conn:
+        rows = conn.execute(SQL_RECURRING, (user_id,)).fetchall()
     return rows
 
+def get_recurring_with_totals(user_id):
+    """Active recurring rows plus their monthly sum per type."""
+    with db() as conn:
+        rows = conn.execute(SQL_RECURRING, (user_id,)).fetchall()
+        totals = dict(conn.execute(SQL_RECURRING_TOTALS, (user_id,)).fetchall())
+    return rows, totals
+
 def delete_recurring(recurring_id, user_id):
-    conn = get_db()
-    conn.execute("UPDATE recurring SET active = 0 WHERE id = ? AND user_id = ?", (recurring_id, user_id))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute(SQL_DISABLE_RECURRING, (recurring_id, user_id))
 
 def apply_recurring_transactions():
     """Check and apply recurring transactions for today."""
-    conn = get_db()
-    today = datetime.now()
+    today = date.today()
     day = today.day
-    month_key = today.strftime("%Y-%m")
-
-    rows = conn.execute(
-        "SELECT * FROM recurring WHERE active = 1 AND day_of_month = ? AND (last_applied IS NULL OR last_applied != ?)",
-        (day, month_key)
-    ).fetchall()
-
-    applied = []
-    for r in rows:
-        conn.execute(
-            "INSERT INTO transactions (user_id, type, category, amount, description, payment_method) VALUES (?, ?, ?, ?, ?, ?)",
-            (r["user_id"], r["type"], r["category"], r["amount"],
-             f"[Auto] {r['description'] or ''}", r["payment_method"])
+    month_key = day_keys(today.toordinal())[3][:7]
+
+    with db_write() as conn:
+        # Take the write lock up front so the SELECT and the writes are atomic
+        conn.execute("BEGIN IMMEDIATE")
+        due = conn.execute(SQL_DUE_RECURRING, (day, month_key)).fetchall()
+        # One bad stored amount must not abort the batch for every user
+        applied = []
+        for r in due:
+            if 0 <= r["amount"] <= MAX_AMOUNT:
+                applied.append(r)
+            else:
+                print(f"⚠️ Skipping recurring #{r['id']}: amount out of range ({r['amount']!r})")
+        conn.executemany(
+            SQL_APPLY_RECURRING_TX,
+            [(r["user_id"], r["type"], r["category"], to_cents(r["amount"]),
+              f"[Auto] {r['description'] or ''}", r["payment_method"]) for r in applied]
         )
-        conn.execute("UPDATE recurring SET last_applied = ? WHERE id = ?", (month_key, r["id"]))
-        applied.append(r)
-
-    conn.commit()
-    conn.close()
+        conn.executemany(
+            SQL_MARK_APPLIED,
+            [(month_key, r["id"]) for r in applied]
+        )
+        for r in applied:
+            _TODAY.pop(r["user_id"], None)
     return applied
 
 # ══════════════════════════════════════════════
@@ -272,28 +516,57 @@ REC_TYPE, REC_CAT, REC_AMOUNT, REC_DESC, REC_DAY, REC_PAY = range(10, 16)
 
 def auth_check(func):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        uid = update.effective_user.id
-        if AUTHORIZED_USERS and uid not in AUTHORIZED_USERS:
+        if _AUTH_REQUIRED and update.effective_user.id not in AUTHORIZED_USERS:
             await update.effective_message.reply_text("⛔ No autorizado.")
             return
         return await func(update, context)
     return wrapper
 
+# "45", "S/1,200.50", "$45 almuerzo" → amount (commas are thousands) + optional description.
+# Digit runs are bounded so float() can never overflow to inf.
+AMOUNT_RE = re.compile(r"^\s*(?:[sS]/|\$)?\s*(\d[\d,]{0,16}\.?\d{0,10}|\.\d{1,10})(?:\s+(\S.*?))?\s*$", re.DOTALL)
+
+def parse_amount(text):
+    """Return (amount, description); amount is 0 when the text isn't one."""
+    # Most messages are a bare integer like "45": skip the regex for those
+    if text.isascii() and text.isdigit():
+        amount = float(text)
+        return (amount if amount <= MAX_AMOUNT else 0), ""
+    m = AMOUNT_RE.match(text)
+    if not m:
+        return 0, ""
+    # Stored as integer cents: round here so "0.001" is rejected as 0, not saved as S/0.00
+    amount = round(float(m.group(1).replace(",", "")), 2)
+    if amount > MAX_AMOUNT:
+        return 0, ""
+    return amount, m.group(2) or ""
+
+@lru_cache(maxsize=4096)
+def _fmt(amount):
+    return f"{CURRENCY}{amount:,.2f}"
+
 def fmt(amount):
     """Format amount in Soles."""
-    return f"{CURRENCY}{amount:,.2f}"
+    # Quantize first so 45, 45.0 and 44.999999 share one cache entry
+    return _fmt(round(amount, 2))
+
+# Reply decorations, built once at import
+SEP = "─" * 28
+BAR_WIDTH = 8
+BAR_FULL = "█" * BAR_WIDTH
+BAR_EMPTY = "░" * BAR_WIDTH
+EMOJI = {"gasto": "💸", "ingreso": "💰"}
 
 # ── /start ──
 
 @auth_check
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    seed_categories(uid)
-    today_total = get_today_total(uid)
-    ingresos, gastos = get_month_summary(uid)
+    await asyncio.to_thread(seed_categories, uid)
+    today_total, ingresos, gastos = await asyncio.to_thread(get_start_stats, uid)
     balance = ingresos - gastos
 
-    sheets_status = "✅ Google Sheets conectado" if sheets_sync.is_enabled() else "⚠️ Google Sheets no configurado"
+    sheets_status = "✅ Google Sheets conectado" if _SHEETS_ENABLED else "⚠️ Google Sheets no configurado"
 
     text = (
         f"👋 ¡Hola {update.effective_user.first_name}!\n\n"
@@ -344,20 +617,31 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # EXPENSE/INCOME REGISTRATION (step by step)
 # ══════════════════════════════════════════════
 
-def category_keyboard(categories, prefix):
-    keyboard = []
-    row = []
-    for cat in categories:
-        row.append(InlineKeyboardButton(cat["name"], callback_data=f"{prefix}|{cat['name']}"))
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="cancel")])
+def category_keyboard(categories, prefix, cancel=True):
+    """Two-column category buttons, optionally followed by a Cancel row."""
+    buttons = [InlineKeyboardButton(cat["name"], callback_data=f"{prefix}|{cat['name']}") for cat in categories]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if cancel:
+        keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="cancel")])
     return InlineKeyboardMarkup(keyboard)
 
-def payment_keyboard(prefix="pay"):
+# Category rows per (user_id, tx_type), shared by every flow that shows them;
+# the set almost never changes
+CAT_CACHE_TTL = 300
+_CAT_CACHE = {}
+
+async def cached_categories(user_id, tx_type, ttl=CAT_CACHE_TTL):
+    """Categories for a user, served from memory for `ttl` seconds."""
+    key = (user_id, tx_type)
+    hit = _CAT_CACHE.get(key)
+    now = time.monotonic()
+    if hit and now - hit[0] < ttl:
+        return hit[1]
+    cats = await asyncio.to_thread(get_or_seed_categories, user_id, tx_type)
+    _CAT_CACHE[key] = (now, cats)
+    return cats
+
+def _payment_keyboard(prefix):
     return InlineKeyboardMarkup([
         [
             InlineKeyboardButton("💵 Efectivo", callback_data=f"{prefix}|Efectivo"),
@@ -374,16 +658,22 @@ def payment_keyboard(prefix="pay"):
         [InlineKeyboardButton("⏭️ Saltar", callback_data=f"{prefix}|No especificado")],
     ])
 
+# Payment keyboards are static: build them once
+PAYMENT_KB = _payment_keyboard("pay")
+QPAYMENT_KB = _payment_keyboard("qpay")
+REC_PAYMENT_KB = _payment_keyboard("rec_pay")
+
+# Category callback_data is "<prefix>|<name>"; one letter of type keeps it short
+CAT_PREFIX = {"gasto": "cg", "ingreso": "ci"}
+CAT_TX_TYPE = {v: k for k, v in CAT_PREFIX.items()}
+
 @auth_check
 async def cmd_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    cats = get_categories(uid, "gasto")
-    if not cats:
-        seed_categories(uid)
-        cats = get_categories(uid, "gasto")
+    keyboard = category_keyboard(await cached_categories(uid, "gasto"), CAT_PREFIX["gasto"])
     await update.message.reply_text(
         "💸 *Registrar Gasto*\n\nSelecciona categoría:",
-        reply_markup=category_keyboard(cats, "cat_gasto"),
+        reply_markup=keyboard,
         parse_mode="Markdown"
     )
     return AMOUNT
@@ -391,13 +681,10 @@ async def cmd_gasto(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @auth_check
 async def cmd_ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    cats = get_categories(uid, "ingreso")
-    if not cats:
-        seed_categories(uid)
-        cats = get_categories(uid, "ingreso")
+    keyboard = category_keyboard(await cached_categories(uid, "ingreso"), CAT_PREFIX["ingreso"])
     await update.message.reply_text(
         "💰 *Registrar Ingreso*\n\nSelecciona categoría:",
-        reply_markup=category_keyboard(cats, "cat_ingreso"),
+        reply_markup=keyboard,
         parse_mode="Markdown"
     )
     return AMOUNT
@@ -405,16 +692,13 @@ async def cmd_ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def category_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    if query.data == "cancel":
-        await query.edit_message_text("❌ Cancelado")
-        return ConversationHandler.END
-
-    tx_type, category = query.data.split("|", 1)
-    tx_type = tx_type.replace("cat_", "")
+    prefix, category = query.data.split("|", 1)
+    # The button carries its own type: /gasto and /ingreso keyboards can coexist
+    tx_type = CAT_TX_TYPE[prefix]
     context.user_data["tx_type"] = tx_type
     context.user_data["category"] = category
 
-    emoji = "💸" if tx_type == "gasto" else "💰"
+    emoji = EMOJI[tx_type]
     await query.edit_message_text(
         f"{emoji} *{category}*\n\n💵 Escribe el monto en soles:",
         parse_mode="Markdown"
@@ -422,19 +706,15 @@ async def category_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return AMOUNT
 
 async def amount_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip().replace(",", "").replace("S/", "").replace("s/", "").replace("$", "")
-    try:
-        amount = float(text)
-        if amount <= 0:
-            raise ValueError
-    except ValueError:
+    amount, extra = parse_amount(update.message.text)
+    if amount <= 0 or extra:
         await update.message.reply_text("❌ Monto inválido. Escribe un número:")
         return AMOUNT
 
     context.user_data["amount"] = amount
     await update.message.reply_text(
         f"💵 Monto: *{fmt(amount)}*\n\n💳 Método de pago:",
-        reply_markup=payment_keyboard("pay"),
+        reply_markup=PAYMENT_KB,
         parse_mode="Markdown"
     )
     return PAYMENT
@@ -471,28 +751,29 @@ async def _save_transaction(update, context, description, photo_path):
     payment = context.user_data.get("payment_method", "Efectivo")
 
     print(f"📝 About to save transaction: user={uid}, type={tx_type}, category={category}, amount={amount}")
-    add_transaction(uid, tx_type, category, amount, description, payment, photo_path)
-
-    today_total = get_today_total(uid)
-    emoji = "💸" if tx_type == "gasto" else "💰"
+    today_total = await asyncio.to_thread(
+        add_transaction, uid, tx_type, category, amount, description, payment, photo_path
+    )
+    queue_sheets_sync(tx_type, category, amount, description, payment)
+    emoji = EMOJI[tx_type]
     tipo_label = "Gasto" if tx_type == "gasto" else "Ingreso"
 
-    text = (
+    parts = [
         f"✅ *{tipo_label} registrado*\n\n"
         f"{emoji} {category}\n"
         f"💵 {fmt(amount)}\n"
         f"💳 {payment}\n"
-    )
+    ]
     if description:
-        text += f"📝 {description}\n"
+        parts.append(f"📝 {description}\n")
     if photo_path:
-        text += f"📸 Foto guardada\n"
+        parts.append("📸 Foto guardada\n")
     if tx_type == "gasto":
-        text += f"\n📊 Total hoy: {fmt(today_total)}"
-    if sheets_sync.is_enabled():
-        text += f"\n📋 Sincronizado con Google Sheets"
+        parts.append(f"\n📊 Total hoy: {fmt(today_total)}")
+    if _SHEETS_ENABLED:
+        parts.append("\n📋 Sincronizado con Google Sheets")
 
-    await update.effective_message.reply_text(text, parse_mode="Markdown")
+    await update.effective_message.reply_text("".join(parts), parse_mode="Markdown")
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -500,117 +781,93 @@ async def _save_transaction(update, context, description, photo_path):
 # QUICK REGISTRATION (just send a number or photo)
 # ══════════════════════════════════════════════
 
-async def _save_photo(update: Update) -> str:
-    """Download and save photo, return file path."""
-    photo = update.message.photo[-1]  # Highest resolution
-    file = await photo.get_file()
+def _photo_path(update: Update) -> str:
+    """Where the message's photo will be stored (PHOTOS_DIR exists from init_db)."""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     uid = update.effective_user.id
-    filename = f"{uid}_{timestamp}.jpg"
-    filepath = os.path.join(PHOTOS_DIR, filename)
+    return os.path.join(PHOTOS_DIR, f"{uid}_{timestamp}.jpg")
+
+async def _download_photo(update: Update, filepath):
+    photo = update.message.photo[-1]  # Highest resolution
+    file = await photo.get_file()
     await file.download_to_drive(filepath)
+
+async def _save_photo(update: Update) -> str:
+    """Download and save photo, return file path."""
+    filepath = _photo_path(update)
+    await _download_photo(update, filepath)
     return filepath
 
 @auth_check
 async def quick_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Photo sent directly — save and ask for amount."""
-    photo_path = await _save_photo(update)
+    # The path is known up front, so the download overlaps the reply below
+    photo_path = _photo_path(update)
+    download = asyncio.create_task(_download_photo(update, photo_path))
     context.user_data["pending_photo"] = photo_path
 
-    caption = update.message.caption or ""
-    parts = caption.strip().split(maxsplit=1)
+    try:
+        # Try to parse amount from caption
+        amount, desc = parse_amount(update.message.caption or "")
+        if amount > 0:
+            context.user_data["amount"] = amount
+            context.user_data["tx_type"] = "gasto"
+            context.user_data["quick_desc"] = desc
+
+            uid = update.effective_user.id
+            cats = await cached_categories(uid, "gasto")
+
+            keyboard = category_keyboard(cats, "quick", cancel=False)
+
+            await update.message.reply_text(
+                f"📸 Foto guardada\n⚡ *Gasto: {fmt(amount)}*\n\nSelecciona categoría:",
+                reply_markup=keyboard,
+                parse_mode="Markdown"
+            )
+            return
 
-    # Try to parse amount from caption
-    if parts:
+        await update.message.reply_text(
+            "📸 Foto guardada ✅\n\n💵 Escribe el monto para registrar el gasto:\n(o escribe `cancelar` para solo guardar la foto)",
+            parse_mode="Markdown"
+        )
+    finally:
         try:
-            amount = float(parts[0].replace(",", "").replace("S/", "").replace("s/", ""))
-            if amount > 0:
-                context.user_data["amount"] = amount
-                context.user_data["tx_type"] = "gasto"
-                context.user_data["quick_desc"] = parts[1] if len(parts) > 1 else ""
-
-                uid = update.effective_user.id
-                cats = get_categories(uid, "gasto")
-                if not cats:
-                    seed_categories(uid)
-                    cats = get_categories(uid, "gasto")
-
-                keyboard = []
-                row = []
-                for cat in cats:
-                    row.append(InlineKeyboardButton(cat["name"], callback_data=f"quick|{cat['name']}"))
-                    if len(row) == 2:
-                        keyboard.append(row)
-                        row = []
-                if row:
-                    keyboard.append(row)
-
-                await update.message.reply_text(
-                    f"📸 Foto guardada\n⚡ *Gasto: {fmt(amount)}*\n\nSelecciona categoría:",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode="Markdown"
-                )
-                return
-        except (ValueError, IndexError):
-            pass
-
-    await update.message.reply_text(
-        "📸 Foto guardada ✅\n\n💵 Escribe el monto para registrar el gasto:\n(o escribe `cancelar` para solo guardar la foto)",
-        parse_mode="Markdown"
-    )
+            await download
+        except Exception as e:
+            print(f"❌ Photo download error: {e}")
+            context.user_data.pop("pending_photo", None)
+            try:
+                os.remove(photo_path)  # drop any partial file
+            except FileNotFoundError:
+                pass
+            await update.message.reply_text("⚠️ No se pudo guardar la foto. Si registras el gasto, quedará sin foto.")
 
 @auth_check
 async def quick_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle plain number messages as quick expense."""
-    text = update.message.text.strip()
-    parts = text.split(maxsplit=1)
-
-    try:
-        amount = float(parts[0].replace(",", "").replace("S/", "").replace("s/", "").replace("$", ""))
-        if amount <= 0:
-            return
-    except (ValueError, IndexError):
-        # Check if there's a pending photo
-        if "pending_photo" in context.user_data:
-            if text.lower() in ("cancelar", "cancel", "no"):
-                photo = context.user_data.pop("pending_photo", None)
-                await update.message.reply_text("📸 Foto guardada sin registro de gasto.")
-                return
-            try:
-                amount = float(text.replace(",", "").replace("S/", "").replace("s/", ""))
-                if amount <= 0:
-                    return
-            except ValueError:
-                return
-        else:
-            return
+    text = update.message.text
+    amount, desc = parse_amount(text)
+    if amount <= 0:
+        # Not an amount: only meaningful as "cancel" for a pending photo
+        if "pending_photo" in context.user_data and text.strip().lower() in ("cancelar", "cancel", "no"):
+            context.user_data.pop("pending_photo", None)
+            await update.message.reply_text("📸 Foto guardada sin registro de gasto.")
+        return
 
-    desc = parts[1] if len(parts) > 1 else ""
     uid = update.effective_user.id
     context.user_data["amount"] = amount
     context.user_data["tx_type"] = "gasto"
     context.user_data["quick_desc"] = desc
 
-    cats = get_categories(uid, "gasto")
-    if not cats:
-        seed_categories(uid)
-        cats = get_categories(uid, "gasto")
+    cats = await cached_categories(uid, "gasto")
 
-    keyboard = []
-    row = []
-    for cat in cats:
-        row.append(InlineKeyboardButton(cat["name"], callback_data=f"quick|{cat['name']}"))
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
+    keyboard = category_keyboard(cats, "quick", cancel=False)
 
     photo_note = "📸 + " if "pending_photo" in context.user_data else ""
     desc_text = f"\n📝 {desc}" if desc else ""
     await update.message.reply_text(
         f"⚡ {photo_note}*Gasto: {fmt(amount)}*{desc_text}\n\nCategoría:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=keyboard,
         parse_mode="Markdown"
     )
 
@@ -623,7 +880,7 @@ async def quick_category_selected(update: Update, context: ContextTypes.DEFAULT_
 
     await query.edit_message_text(
         f"⚡ *{fmt(amount)}* → {category}\n\n💳 Método de pago:",
-        reply_markup=payment_keyboard("qpay"),
+        reply_markup=QPAYMENT_KB,
         parse_mode="Markdown"
     )
 
@@ -639,24 +896,24 @@ async def quick_payment_selected(update: Update, context: ContextTypes.DEFAULT_T
     photo_path = context.user_data.pop("pending_photo", None)
 
     print(f"📝 About to save QUICK transaction: user={uid}, type=gasto, category={category}, amount={amount}")
-    add_transaction(uid, "gasto", category, amount, desc, payment, photo_path)
-    today_total = get_today_total(uid)
+    today_total = await asyncio.to_thread(add_transaction, uid, "gasto", category, amount, desc, payment, photo_path)
+    queue_sheets_sync("gasto", category, amount, desc, payment)
 
-    text = (
+    parts = [
         f"✅ *Gasto registrado*\n\n"
         f"💸 {category}\n"
         f"💵 {fmt(amount)}\n"
         f"💳 {payment}\n"
-    )
+    ]
     if desc:
-        text += f"📝 {desc}\n"
+        parts.append(f"📝 {desc}\n")
     if photo_path:
-        text += f"📸 Foto guardada\n"
-    text += f"\n📊 Total hoy: {fmt(today_total)}"
-    if sheets_sync.is_enabled():
-        text += f"\n📋 Sincronizado con Google Sheets"
+        parts.append("📸 Foto guardada\n")
+    parts.append(f"\n📊 Total hoy: {fmt(today_total)}")
+    if _SHEETS_ENABLED:
+        parts.append("\n📋 Sincronizado con Google Sheets")
 
-    await query.edit_message_text(text, parse_mode="Markdown")
+    await query.edit_message_text("".join(parts), parse_mode="Markdown")
     context.user_data.clear()
 
 # ══════════════════════════════════════════════
@@ -682,33 +939,18 @@ async def cmd_fijo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def rec_type_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    if query.data == "rec_cancel":
-        await query.edit_message_text("❌ Cancelado")
-        return ConversationHandler.END
-
     tx_type = query.data.split("|")[1]
     context.user_data["rec_type"] = tx_type
     uid = query.from_user.id
 
-    cats = get_categories(uid, tx_type)
-    if not cats:
-        seed_categories(uid)
-        cats = get_categories(uid, tx_type)
+    cats = await cached_categories(uid, tx_type)
 
-    keyboard = []
-    row = []
-    for cat in cats:
-        row.append(InlineKeyboardButton(cat["name"], callback_data=f"rec_cat|{cat['name']}"))
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
+    keyboard = category_keyboard(cats, "rec_cat", cancel=False)
 
     tipo_label = "Gasto" if tx_type == "gasto" else "Ingreso"
     await query.edit_message_text(
         f"🔄 *{tipo_label} Fijo*\n\nSelecciona categoría:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=keyboard,
         parse_mode="Markdown"
     )
     return REC_CAT
@@ -726,12 +968,8 @@ async def rec_cat_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return REC_AMOUNT
 
 async def rec_amount_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip().replace(",", "").replace("S/", "").replace("s/", "")
-    try:
-        amount = float(text)
-        if amount <= 0:
-            raise ValueError
-    except ValueError:
+    amount, extra = parse_amount(update.message.text)
+    if amount <= 0 or extra:
         await update.message.reply_text("❌ Monto inválido:")
         return REC_AMOUNT
 
@@ -766,7 +1004,7 @@ async def rec_day_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["rec_day"] = day
     await update.message.reply_text(
         f"📅 Día {day} de cada mes\n\n💳 Método de pago:",
-        reply_markup=payment_keyboard("rec_pay"),
+        reply_markup=REC_PAYMENT_KB,
         parse_mode="Markdown"
     )
     return REC_PAY
@@ -783,7 +1021,7 @@ async def rec_payment_selected(update: Update, context: ContextTypes.DEFAULT_TYP
     desc = context.user_data.get("rec_desc", "")
     day = context.user_data["rec_day"]
 
-    add_recurring(uid, tx_type, category, amount, desc, payment, day)
+    await asyncio.to_thread(add_recurring, uid, tx_type, category, amount, desc, payment, day)
 
     tipo_label = "Gasto" if tx_type == "gasto" else "Ingreso"
     text = (
@@ -804,38 +1042,36 @@ async def rec_payment_selected(update: Update, context: ContextTypes.DEFAULT_TYP
 @auth_check
 async def cmd_fijos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    rows = get_recurring(uid)
+    rows, totals = await asyncio.to_thread(get_recurring_with_totals, uid)
 
     if not rows:
         await update.message.reply_text("No tienes gastos/ingresos fijos configurados.\nUsa /fijo para agregar uno.")
         return
 
-    text = "🔄 *Gastos e Ingresos Fijos*\n" + "─" * 28 + "\n\n"
-
-    total_gastos = 0
-    total_ingresos = 0
+    parts = ["🔄 *Gastos e Ingresos Fijos*\n", SEP, "\n\n"]
 
     for r in rows:
-        emoji = "💸" if r["type"] == "gasto" else "💰"
+        emoji = EMOJI[r["type"]]
         desc = f" — {r['description']}" if r["description"] else ""
-        text += f"{emoji} *#{r['id']}* {r['category']}\n   {fmt(r['amount'])} · Día {r['day_of_month']} · {r['payment_method']}{desc}\n\n"
-        if r["type"] == "gasto":
-            total_gastos += r["amount"]
-        else:
-            total_ingresos += r["amount"]
+        parts.append(f"{emoji} *#{r['id']}* {r['category']}\n   {fmt(r['amount'])} · Día {r['day_of_month']} · {r['payment_method']}{desc}\n\n")
 
-    text += f"{'─' * 28}\n"
-    text += f"💰 Ingresos fijos: {fmt(total_ingresos)}/mes\n"
-    text += f"💸 Gastos fijos: {fmt(total_gastos)}/mes\n"
-    text += f"📊 Disponible: {fmt(total_ingresos - total_gastos)}/mes\n"
-    text += f"\nUsa /quitarfijo para desactivar uno."
+    total_gastos = totals.get("gasto", 0)
+    total_ingresos = totals.get("ingreso", 0)
 
-    await update.message.reply_text(text, parse_mode="Markdown")
+    parts.append(
+        f"{SEP}\n"
+        f"💰 Ingresos fijos: {fmt(total_ingresos)}/mes\n"
+        f"💸 Gastos fijos: {fmt(total_gastos)}/mes\n"
+        f"📊 Disponible: {fmt(total_ingresos - total_gastos)}/mes\n"
+        f"\nUsa /quitarfijo para desactivar uno."
+    )
+
+    await update.message.reply_text("".join(parts), parse_mode="Markdown")
 
 @auth_check
 async def cmd_quitarfijo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    rows = get_recurring(uid)
+    rows = await asyncio.to_thread(get_recurring, uid)
 
     if not rows:
         await update.message.reply_text("No tienes fijos configurados.")
@@ -843,7 +1079,7 @@ async def cmd_quitarfijo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     keyboard = []
     for r in rows:
-        emoji = "💸" if r["type"] == "gasto" else "💰"
+        emoji = EMOJI[r["type"]]
         label = f"{emoji} {r['category']} · {fmt(r['amount'])}"
         keyboard.append([InlineKeyboardButton(label, callback_data=f"del_rec|{r['id']}")])
     keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="del_rec|cancel")])
@@ -863,7 +1099,7 @@ async def delete_recurring_handler(update: Update, context: ContextTypes.DEFAULT
         return
 
     uid = query.from_user.id
-    delete_recurring(int(data), uid)
+    await asyncio.to_thread(delete_recurring, int(data), uid)
     await query.edit_message_text("✅ Fijo desactivado")
 
 # ══════════════════════════════════════════════
@@ -873,83 +1109,86 @@ async def delete_recurring_handler(update: Update, context: ContextTypes.DEFAULT
 @auth_check
 async def cmd_resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    ingresos, gastos = get_month_summary(uid)
+    (ingresos, gastos, by_category), daily = await asyncio.gather(
+        asyncio.to_thread(get_resumen, uid, 30),
+        asyncio.to_thread(monthly_stats, uid),
+    )
     balance = ingresos - gastos
     ahorro_pct = (balance / ingresos * 100) if ingresos > 0 else 0
-    by_category = get_summary_by_category(uid, days=30)
 
     bar_max = max((row["total"] for row in by_category), default=1)
 
     text = (
-        f"📊 *Resumen del Mes*\n{'─' * 28}\n\n"
+        f"📊 *Resumen del Mes*\n{SEP}\n\n"
         f"💰 Ingresos:  {fmt(ingresos)}\n"
         f"💸 Gastos:    {fmt(gastos)}\n"
-        f"{'─' * 28}\n"
+        f"{SEP}\n"
         f"📊 Balance:   {fmt(balance)}\n"
         f"📈 Ahorro:    {ahorro_pct:.1f}%\n\n"
     )
+    if daily["days"]:
+        text += (
+            f"📆 *Gasto diario* ({daily['days']} días con gastos)\n"
+            f"   Promedio {fmt(daily['mean'])} · P90 {fmt(daily['p90'])} · Máx {fmt(daily['max'])}\n\n"
+        )
 
     if by_category:
-        text += "*Gastos por categoría:*\n"
+        parts = ["*Gastos por categoría:*\n"]
         for row in by_category:
-            bar_len = int((row["total"] / bar_max) * 8) if bar_max > 0 else 0
-            bar = "█" * bar_len + "░" * (8 - bar_len)
+            bar_len = int(row["total"] * BAR_WIDTH // bar_max) if bar_max > 0 else 0
             pct = (row["total"] / gastos * 100) if gastos > 0 else 0
-            text += f"`{bar}` {row['category']}\n  {fmt(row['total'])} ({pct:.0f}%) · {row['count']} registros\n"
+            parts.append(
+                f"`{BAR_FULL[:bar_len]}{BAR_EMPTY[bar_len:]}` {row['category']}\n"
+                f"  {fmt(row['total'])} ({pct:.0f}%) · {row['count']} registros\n"
+            )
+        text += "".join(parts)
 
     await update.message.reply_text(text, parse_mode="Markdown")
 
 @auth_check
 async def cmd_hoy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    conn = get_db()
-    today = datetime.now().strftime("%Y-%m-%d")
-    rows = conn.execute("""
-        SELECT category, amount, description, payment_method, photo_path
-        FROM transactions
-        WHERE user_id = ? AND type = 'gasto' AND DATE(created_at) = ?
-        ORDER BY created_at DESC
-    """, (uid, today)).fetchall()
-    conn.close()
+    rows = await asyncio.to_thread(get_today_gastos, uid)
 
     total = sum(r["amount"] for r in rows)
-    text = f"📅 *Gastos de Hoy*\n{'─' * 28}\n\n"
+    parts = [f"📅 *Gastos de Hoy*\n{SEP}\n\n"]
 
     if not rows:
-        text += "🎉 ¡No has gastado nada hoy!"
+        parts.append("🎉 ¡No has gastado nada hoy!")
     else:
         for r in rows:
             desc = f" — {r['description']}" if r["description"] else ""
             photo = " 📸" if r["photo_path"] else ""
-            text += f"• {r['category']} → {fmt(r['amount'])}{desc}{photo}\n  _{r['payment_method']}_\n"
-        text += f"\n{'─' * 28}\n💸 *Total: {fmt(total)}*"
+            parts.append(f"• {r['category']} → {fmt(r['amount'])}{desc}{photo}\n  _{r['payment_method']}_\n")
+        parts.append(f"\n{SEP}\n💸 *Total: {fmt(total)}*")
 
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await update.message.reply_text("".join(parts), parse_mode="Markdown")
 
 @auth_check
 async def cmd_recientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    rows = get_recent(uid, 10)
+    rows = await asyncio.to_thread(get_recent, uid, 10)
 
-    text = f"🕐 *Últimos Movimientos*\n{'─' * 28}\n\n"
+    header = f"🕐 *Últimos Movimientos*\n{SEP}\n\n"
 
     if not rows:
-        text += "No hay movimientos registrados."
+        text = header + "No hay movimientos registrados."
     else:
-        for r in rows:
-            emoji = "💸" if r["type"] == "gasto" else "💰"
-            dt = datetime.fromisoformat(r["created_at"]).strftime("%d/%m %H:%M")
-            desc = f" — {r['description']}" if r["description"] else ""
-            photo = " 📸" if r["photo_path"] else ""
-            text += f"{emoji} `{dt}` {r['category']}\n   {fmt(r['amount'])} · {r['payment_method']}{desc}{photo}\n\n"
+        text = header + "".join([
+            f"{EMOJI[r['type']]} `{r['dt']}` {r['category']}\n"
+            f"   {fmt(r['amount'])} · {r['payment_method']}"
+            f"{' — ' + r['description'] if r['description'] else ''}{' 📸' if r['photo_path'] else ''}\n\n"
+            for r in rows
+        ])
 
     await update.message.reply_text(text, parse_mode="Markdown")
 
 @auth_check
 async def cmd_borrar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    deleted = delete_last_transaction(uid)
+    deleted = await asyncio.to_thread(delete_last_transaction, uid)
     if deleted:
+        queue_sheets_delete()
         await update.message.reply_text(
             f"🗑️ *Eliminado:* {deleted['category']} → {fmt(deleted['amount'])}",
             parse_mode="Markdown"
@@ -961,23 +1200,49 @@ async def cmd_borrar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # RECURRING JOB (runs daily)
 # ══════════════════════════════════════════════
 
+# Parallel sends per job run, kept under Telegram's ~30 msg/s bot-wide limit
+NOTIFY_CONCURRENCY = 20
+
 async def daily_recurring_job(context: ContextTypes.DEFAULT_TYPE):
     """Apply recurring transactions and notify users."""
-    applied = apply_recurring_transactions()
+    applied = await asyncio.to_thread(apply_recurring_transactions)
+    if not applied:
+        return
     # Group by user
-    by_user = {}
+    by_user = defaultdict(list)
     for r in applied:
-        by_user.setdefault(r["user_id"], []).append(r)
+        by_user[r["user_id"]].append(r)
 
-    for uid, items in by_user.items():
-        text = "🔄 *Registros automáticos de hoy:*\n\n"
-        for r in items:
-            emoji = "💸" if r["type"] == "gasto" else "💰"
-            text += f"{emoji} {r['category']} → {fmt(r['amount'])}\n"
-        try:
-            await context.bot.send_message(chat_id=uid, text=text, parse_mode="Markdown")
-        except Exception:
-            pass
+    sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def notify(uid, items):
+        # HTML: no Markdown parsing surprises from category names
+        text = "🔄 <b>Registros automáticos de hoy:</b>\n\n" + "\n".join(
+            f"{EMOJI[r['type']]} {html.escape(r['category'])} → {fmt(r['amount'])}" for r in items
+        )
+        async with sem:
+            try:
+                await context.bot.send_message(chat_id=uid, text=text, parse_mode="HTML")
+            except Exception:
+                pass
+
+    await asyncio.gather(*(notify(uid, items) for uid, items in by_user.items()))
+
+async def wal_checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic checkpoint so pooled readers can't starve the WAL autocheckpoint."""
+    await asyncio.to_thread(checkpoint_wal)
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route callbacks not claimed by a conversation by their prefix."""
+    data = update.callback_query.data
+    if data.startswith("quick|"):
+        return await quick_category_selected(update, context)
+    if data.startswith("qpay|"):
+        return await quick_payment_selected(update, context)
+    if data.startswith("del_rec|"):
+        return await delete_recurring_handler(update, context)
+    # Stale button from a finished conversation: just stop the spinner
+    await update.callback_query.answer()
 
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
@@ -988,6 +1253,78 @@ async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Cancelado")
     return ConversationHandler.END
 
+# ══════════════════════════════════════════════
+# GOOGLE SHEETS SYNC (background)
+# ══════════════════════════════════════════════
+
+# Sheets writes never sit on the reply path: handlers enqueue them and a single
+# worker flushes bursts with one append_rows call. Deletes go through the same
+# queue (as None) so they can't overtake a pending append.
+SHEETS_BATCH = 20
+SHEETS_DEBOUNCE = 0.5
+_SHEETS_Q = asyncio.Queue()
+_SHEETS_STOP = object()  # queued by stop_sheets_worker; everything before it is flushed
+_SHEETS_TASK = None
+
+def queue_sheets_sync(tx_type, category, amount, description="", payment_method="Efectivo"):
+    if _SHEETS_ENABLED:
+        _SHEETS_Q.put_nowait((tx_type, category, amount, description, payment_method, datetime.now()))
+
+def queue_sheets_delete():
+    if _SHEETS_ENABLED:
+        _SHEETS_Q.put_nowait(None)
+
+def _flush_sheets(batch):
+    """Send queued items in order: runs of appends go out as one call."""
+    rows = []
+    for item in batch:
+        if item is not None:
+            rows.append(item)
+            continue
+        if rows:
+            sheets_sync.sync_many(rows)
+            rows = []
+        sheets_sync.sync_delete_last()
+    if rows:
+        sheets_sync.sync_many(rows)
+
+async def _sheets_worker():
+    """Flush queued items until the _SHEETS_STOP sentinel comes through."""
+    while True:
+        item = await _SHEETS_Q.get()
+        if item is _SHEETS_STOP:
+            return
+        batch = [item]
+        await asyncio.sleep(SHEETS_DEBOUNCE)
+        stop = False
+        while len(batch) < SHEETS_BATCH and not _SHEETS_Q.empty():
+            item = _SHEETS_Q.get_nowait()
+            if item is _SHEETS_STOP:
+                stop = True
+                break
+            batch.append(item)
+        try:
+            await asyncio.to_thread(_flush_sheets, batch)
+        except Exception as e:
+            print(f"❌ Sheets worker error: {e}")
+        if stop:
+            return
+
+async def start_sheets_worker(app: Application):
+    global _SHEETS_TASK
+    if _SHEETS_ENABLED:
+        # Not app.create_task: PTB awaits those on stop and this one never ends
+        _SHEETS_TASK = asyncio.create_task(_sheets_worker())
+
+async def stop_sheets_worker(app: Application):
+    """Let the worker flush everything queued, then close the Sheets session."""
+    if _SHEETS_TASK:
+        # Not cancel(): the worker may hold a batch or be mid-flush in a thread
+        _SHEETS_Q.put_nowait(_SHEETS_STOP)
+        await _SHEETS_TASK
+    if _SHEETS_ENABLED:
+        sheets_sync.close()
+
 # ══════════════════════════════════════════════
 # MAIN
 # ══════════════════════════════════════════════
@@ -998,6 +1335,14 @@ def main():
         print("❌ Set TELEGRAM_BOT_TOKEN")
         return
 
+    # Faster event loop when available (Linux/macOS); run_polling creates its
+    # loop from the policy
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     init_db()
 
     # Setup Google Sheets
@@ -1006,7 +1351,7 @@ def main():
     print(f"   GOOGLE_CREDENTIALS_JSON: {'✅ Set' if os.environ.get('GOOGLE_CREDENTIALS_JSON') else '❌ Not set'}")
     print(f"   GOOGLE_CREDENTIALS_FILE: {'✅ Set' if os.environ.get('GOOGLE_CREDENTIALS_FILE') else '❌ Not set'}")
     
-    if sheets_sync.is_enabled():
+    if _SHEETS_ENABLED:
         print("✅ Google Sheets is enabled, attempting connection...")
         if sheets_sync.setup_sheet_headers():
             print("📋 Google Sheets connected successfully")
@@ -1015,15 +1360,26 @@ def main():
     else:
         print("ℹ️ Google Sheets not configured (optional)")
 
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(start_sheets_worker)
+        .post_shutdown(stop_sheets_worker)
+        .build()
+    )
+
+    # /cancel or the conversation's own Cancel button ends it from any step;
+    # a stale button from another flow doesn't match
+    cancel_cmd = CommandHandler("cancel", cancel_conversation)
+    tx_fallbacks = [cancel_cmd, CallbackQueryHandler(cancel_conversation, pattern=r"^cancel$")]
+    rec_fallbacks = [cancel_cmd, CallbackQueryHandler(cancel_conversation, pattern=r"^rec_cancel$")]
 
     # ── Conversation: /gasto ──
     gasto_conv = ConversationHandler(
         entry_points=[CommandHandler("gasto", cmd_gasto)],
         states={
             AMOUNT: [
-                CallbackQueryHandler(category_selected, pattern=r"^cat_"),
-                CallbackQueryHandler(cancel_conversation, pattern=r"^cancel$"),
+                CallbackQueryHandler(category_selected, pattern=r"^c[gi]\|"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, amount_received),
             ],
             PAYMENT: [CallbackQueryHandler(payment_selected, pattern=r"^pay\|")],
@@ -1032,7 +1388,7 @@ def main():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, description_received),
             ],
         },
-        fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        fallbacks=tx_fallbacks,
         per_message=False,
     )
 
@@ -1041,8 +1397,7 @@ def main():
         entry_points=[CommandHandler("ingreso", cmd_ingreso)],
         states={
             AMOUNT: [
-                CallbackQueryHandler(category_selected, pattern=r"^cat_"),
-                CallbackQueryHandler(cancel_conversation, pattern=r"^cancel$"),
+                CallbackQueryHandler(category_selected, pattern=r"^c[gi]\|"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, amount_received),
             ],
             PAYMENT: [CallbackQueryHandler(payment_selected, pattern=r"^pay\|")],
@@ -1051,7 +1406,7 @@ def main():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, description_received),
             ],
         },
-        fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        fallbacks=tx_fallbacks,
         per_message=False,
     )
 
@@ -1061,7 +1416,6 @@ def main():
         states={
             REC_TYPE: [
                 CallbackQueryHandler(rec_type_selected, pattern=r"^rec_type\|"),
-                CallbackQueryHandler(cancel_conversation, pattern=r"^rec_cancel$"),
             ],
             REC_CAT: [CallbackQueryHandler(rec_cat_selected, pattern=r"^rec_cat\|")],
             REC_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, rec_amount_received)],
@@ -1069,7 +1423,7 @@ def main():
             REC_DAY: [MessageHandler(filters.TEXT & ~filters.COMMAND, rec_day_received)],
             REC_PAY: [CallbackQueryHandler(rec_payment_selected, pattern=r"^rec_pay\|")],
         },
-        fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        fallbacks=rec_fallbacks,
         per_message=False,
     )
 
@@ -1087,10 +1441,8 @@ def main():
     app.add_handler(ingreso_conv)
     app.add_handler(fijo_conv)
 
-    # Callback handlers for quick flow and delete recurring
-    app.add_handler(CallbackQueryHandler(quick_category_selected, pattern=r"^quick\|"))
-    app.add_handler(CallbackQueryHandler(quick_payment_selected, pattern=r"^qpay\|"))
-    app.add_handler(CallbackQueryHandler(delete_recurring_handler, pattern=r"^del_rec\|"))
+    # Callbacks outside the conversations (quick flow, delete recurring)
+    app.add_handler(CallbackQueryHandler(on_callback))
 
     # Photo handler (quick flow)
     app.add_handler(MessageHandler(filters.PHOTO, quick_photo))
@@ -1103,9 +1455,11 @@ def main():
     if job_queue:
         from datetime import time as dt_time
         job_queue.run_daily(daily_recurring_job, time=dt_time(hour=13, minute=0, second=0))
+        job_queue.run_repeating(wal_checkpoint_job, interval=60, first=60)
 
     print("🤖 GastosBot running...")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
+    close_pool()
 
 if __name__ == "__main__":
     main()
@@ -5,20 +5,30 @@ Syncs transactions to a Google Sheet automatically.
 
 import os
 import json
-import gspread
-from google.oauth2.service_account import Credentials
+import time
 from datetime import datetime
 
+# gspread/google-auth are imported where first needed, so a bot running
+# without Sheets never loads them
+
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
+HTTP_TIMEOUT = (5, 30)  # connect, read (seconds)
+SHEET_TTL = 600  # re-open the worksheet (and recount rows) every 10 minutes
+
 _client = None
 _sheet = None
+_sheet_at = 0
+_row_count = None  # rows in use, header included; None = unknown
 
 def _get_client():
     global _client
     if _client:
         return _client
 
+    import gspread
+    from google.oauth2.service_account import Credentials
+
     creds_json = os.environ.get("GOOGLE_CREDENTIALS_JSON", "")
     creds_file = os.environ.get("GOOGLE_CREDENTIALS_FILE", "")
 
@@ -37,14 +47,19 @@ def _get_client():
     else:
         return None
 
+    # The client's AuthorizedSession keeps the HTTPS connection and OAuth
+    # token alive, so it's built once and reused for every sync call
     _client = gspread.authorize(creds)
+    _client.set_timeout(HTTP_TIMEOUT)
     return _client
 
 
 def _get_sheet():
-    global _sheet
-    if _sheet:
+    global _sheet, _sheet_at, _row_count
+    if _sheet and time.monotonic() - _sheet_at < SHEET_TTL:
         return _sheet
+    _sheet = None
+    _row_count = None
 
     client = _get_client()
     if not client:
@@ -56,6 +71,8 @@ def _get_sheet():
         print("❌ GOOGLE_SHEETS_ID not configured")
         return None
 
+    import gspread
+
     try:
         print(f"📊 Opening spreadsheet with ID: {sheet_id}")
         spreadsheet = client.open_by_key(sheet_id)
@@ -66,12 +83,23 @@ def _get_sheet():
         except gspread.exceptions.WorksheetNotFound:
             _sheet = spreadsheet.sheet1
             print("✅ Using first worksheet")
+        _sheet_at = time.monotonic()
         return _sheet
     except Exception as e:
         print(f"❌ Google Sheets error: {e}")
         return None
 
 
+def close():
+    """Close the pooled HTTP session (call once on shutdown)."""
+    global _client, _sheet, _row_count
+    if _client:
+        _client.http_client.session.close()
+    _client = None
+    _sheet = None
+    _row_count = None
+
+
 def is_enabled():
     return bool(os.environ.get("GOOGLE_SHEETS_ID")) and bool(
         os.environ.get("GOOGLE_CREDENTIALS_JSON") or os.environ.get("GOOGLE_CREDENTIALS_FILE")
@@ -101,33 +129,56 @@ def setup_sheet_headers():
         return False
 
 
+def _used_rows(sheet):
+    """Rows in use, read from column A once and then tracked locally."""
+    global _row_count
+    if _row_count is None:
+        _row_count = len(sheet.col_values(1))
+    return _row_count
+
+
+def _row(tx_type, category, amount, description="", payment_method="Efectivo", when=None):
+    when = when or datetime.now()
+    return [
+        when.strftime("%d/%m/%Y"),
+        "Gasto" if tx_type == "gasto" else "Ingreso",
+        category,
+        description or "",
+        amount,
+        payment_method,
+        when.strftime("%H:%M"),
+    ]
+
+
 def sync_transaction(tx_type, category, amount, description="", payment_method="Efectivo"):
     """Append a transaction row to Google Sheet."""
     print(f"📝 Attempting to sync transaction: {tx_type}, {category}, {amount}")
+    return sync_many([(tx_type, category, amount, description, payment_method)])
+
+
+def sync_many(transactions):
+    """Append several transactions in a single API call.
+
+    Each item is (tx_type, category, amount, description, payment_method[, when]).
+    """
     sheet = _get_sheet()
     if not sheet:
         print("❌ Could not get sheet object")
         return False
 
+    global _sheet, _row_count
     try:
-        now = datetime.now()
-        row = [
-            now.strftime("%d/%m/%Y"),
-            "Gasto" if tx_type == "gasto" else "Ingreso",
-            category,
-            description or "",
-            amount,
-            payment_method,
-            now.strftime("%H:%M"),
-        ]
-        sheet.append_row(row, value_input_option="USER_ENTERED")
-        print(f"✅ Transaction synced to Google Sheets: {row}")
+        rows = [_row(*tx) for tx in transactions]
+        sheet.append_rows(rows, value_input_option="USER_ENTERED")
+        if _row_count is not None:
+            _row_count += len(rows)
+        print(f"✅ {len(rows)} transaction(s) synced to Google Sheets")
         return True
     except Exception as e:
         print(f"❌ Sync error: {e}")
         # Reset sheet cache in case of auth issues
-        global _sheet
         _sheet = None
+        _row_count = None
         return False
 
 
@@ -137,13 +188,16 @@ def sync_delete_last():
     if not sheet:
         return False
 
+    global _row_count
     try:
-        all_rows = sheet.get_all_values()
-        if len(all_rows) > 1:  # More than just headers
-            sheet.delete_rows(len(all_rows))
+        last = _used_rows(sheet)
+        if last > 1:  # More than just headers
+            sheet.delete_rows(last)
+            _row_count = last - 1
         return True
     except Exception as e:
         print(f"❌ Delete sync error: {e}")
+        _row_count = None
         return False
 
 
@@ -153,6 +207,6 @@ def get_row_count():
     if not sheet:
         return 0
     try:
-        return len(sheet.get_all_values()) - 1  # Minus header
-    except:
+        return max(_used_rows(sheet) - 1, 0)  # Minus header
+    except Exception:
         return 0